@@ -3,12 +3,16 @@ from __future__ import absolute_import
 from got10k.experiments import ExperimentGOT10k
 
 from goturn import TrackerGOTURN
+from helper import enable_fast_backends
 
 
 if __name__ == '__main__':
+    enable_fast_backends()
+
     # setup tracker
     net_path = "../checkpoints/pytorch_goturn.pth.tar"
-    tracker = TrackerGOTURN(net_path=net_path)
+    # fully connected layers are quantized to INT8 when running on CPU
+    tracker = TrackerGOTURN(net_path=net_path, quantize=True)
 
     # setup experiments
     # got10k toolkit expects either extracted directories or zip files for
@@ -1,4 +1,5 @@
 import torch
+import torch.nn as nn
 import numpy as np
 import cv2
 from torchvision import transforms
@@ -23,7 +24,7 @@ class TrackerGOTURN(Tracker):
         transform_tensor: normalizes images and returns torch tensor.
         otps: bounding box config to unscale and uncenter network output.
     """
-    def __init__(self, net_path=None, **kargs):
+    def __init__(self, net_path=None, quantize=False, **kargs):
         super(TrackerGOTURN, self).__init__(
             name='PyTorchGOTURN', is_deterministic=True)
 
@@ -37,9 +38,24 @@ class TrackerGOTURN(Tracker):
             checkpoint = torch.load(
                 net_path, map_location=lambda storage, loc: storage)
             self.net.load_state_dict(checkpoint['state_dict'])
-            self.net.eval()
+        self.net.to_inference()
+        self.net.eval()
+        # dynamic INT8 quantization of the fully connected layers, only
+        # supported by the CPU backends
+        if quantize and not self.cuda:
+            self.net.classifier = torch.quantization.quantize_dynamic(
+                self.net.classifier, {nn.Linear}, dtype=torch.qint8)
         self.net = self.net.to(self.device)
 
+        # compile the fully connected layers after loading the weights, the
+        # compiled module would not match the checkpoint keys otherwise
+        if hasattr(torch, 'compile'):
+            self.net.classifier = torch.compile(self.net.classifier,
+                                                mode='reduce-overhead')
+        else:
+            self.net.classifier = torch.jit.script(self.net.classifier)
+        self._warmup()
+
         # setup transforms
         self.prev_img = None  # previous image in numpy format
         self.prev_box = None  # follows format: [xmin, ymin, xmax, ymax]
@@ -93,6 +109,15 @@ class TrackerGOTURN(Tracker):
         box[3] = box[3]-box[1]
         return box
 
+    def _warmup(self):
+        """
+        Runs a dummy forward pass so that the compilation cost is paid at
+        initialization instead of on the first tracked frame.
+        """
+        x = torch.zeros(1, 3, 224, 224, device=self.device)
+        with torch.no_grad():
+            self.net(x, x)
+
     def _get_rect(self, sample):
         """
         Performs forward pass through the GOTURN network to regress
@@ -101,7 +126,8 @@ class TrackerGOTURN(Tracker):
         x1, x2 = sample['previmg'], sample['currimg']
         x1 = x1.unsqueeze(0).to(self.device)
         x2 = x2.unsqueeze(0).to(self.device)
-        y = self.net(x1, x2)
+        with torch.no_grad():
+            y = self.net(x1, x2)
         bb = y.data.cpu().numpy().transpose((1, 0))
         bb = bb[:, 0]
         bbox = BoundingBox(bb[0], bb[1], bb[2], bb[3])
@@ -143,7 +169,8 @@ class TrackerSPP_GOTURN(Tracker):
             checkpoint = torch.load(
                 net_path, map_location=lambda storage, loc: storage)
             self.net.load_state_dict(checkpoint['state_dict'])
-            self.net.eval()
+        self.net.to_inference()
+        self.net.eval()
         self.net = self.net.to(self.device)
 
         # setup transforms
@@ -207,7 +234,8 @@ class TrackerSPP_GOTURN(Tracker):
         x1, x2 = sample['previmg'], sample['currimg']
         x1 = x1.unsqueeze(0).to(self.device)
         x2 = x2.unsqueeze(0).to(self.device)
-        y = self.net(x1, x2)
+        with torch.no_grad():
+            y = self.net(x1, x2)
         bb = y.data.cpu().numpy().transpose((1, 0))
         bb = bb[:, 0]
         bbox = BoundingBox(bb[0], bb[1], bb[2], bb[3])
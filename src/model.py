@@ -1,10 +1,79 @@
+import os
+import tempfile
+
 import torch
 from torchvision import models
 import torch.nn as nn
 import torch.nn.functional as F
 
+# directory where the weights of the pretrained convnets are cached, next
+# to the full torchvision weights in the torch hub cache
+CONVNET_CACHE_DIR = os.path.join(torch.hub.get_dir(), 'pygoturn')
+
+
+def _alexnet_layers(pretrained):
+    caffenet = models.alexnet(pretrained=pretrained)
+    return list(caffenet.children())
+
+
+def _squeezenet_layers(pretrained):
+    caffenet = models.squeezenet1_1(pretrained=pretrained)
+    return list(caffenet.features.children())
 
-class GoNet(nn.Module):
+
+def _pretrained_convnet(cache_file, get_layers, end):
+    """
+    Builds the convnet from the first layers (up to `end`) returned by
+    `get_layers` and loads their pretrained weights. On first use the full
+    torchvision model is loaded and only the convnet weights are saved to
+    `cache_file` in CONVNET_CACHE_DIR, later calls load this much smaller
+    file instead.
+    """
+    cache_path = os.path.join(CONVNET_CACHE_DIR, cache_file)
+    cached = os.path.isfile(cache_path)
+    convnet = nn.Sequential(*get_layers(pretrained=not cached)[:end])
+    if cached:
+        state = torch.load(cache_path,
+                           map_location=lambda storage, loc: storage)
+        convnet.load_state_dict(state)
+    else:
+        os.makedirs(CONVNET_CACHE_DIR, exist_ok=True)
+        # write to a temporary file and move it into place, so that an
+        # interrupted or concurrent save never leaves a truncated cache
+        fd, tmp_path = tempfile.mkstemp(dir=CONVNET_CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(convnet.state_dict(), f)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return convnet
+
+
+class _GoNetMixin(object):
+    """
+    Methods shared by the GOTURN models, which consist of a frozen
+    pretrained `convnet` and a fully connected `classifier`.
+    """
+    def to_inference(self):
+        """
+        Replaces dropout layers of the classifier by identity layers, they
+        are no-ops at inference but still cost a kernel launch each.
+        """
+        for i, m in enumerate(self.classifier):
+            if isinstance(m, nn.Dropout):
+                self.classifier[i] = nn.Identity()
+        return self
+
+    def train(self, mode=True):
+        # the pretrained convnet is frozen and always stays in eval mode
+        super(_GoNetMixin, self).train(mode)
+        self.convnet.eval()
+        return self
+
+
+class GoNet(_GoNetMixin, nn.Module):
     """ Neural Network class
         Two stream model:
         ________
@@ -25,10 +94,11 @@ class GoNet(nn.Module):
     """
     def __init__(self):
         super(GoNet, self).__init__()
-        caffenet = models.alexnet(pretrained=True)
-        self.convnet = nn.Sequential(*list(caffenet.children())[:-1])
+        self.convnet = _pretrained_convnet('conv_alexnet.pt',
+                                           _alexnet_layers, -1)
         for param in self.convnet.parameters():
             param.requires_grad = False
+        self.convnet.eval()
         self.classifier = nn.Sequential(
                 nn.Linear(256*6*6*2, 4096),
                 nn.ReLU(inplace=True),
@@ -54,15 +124,17 @@ class GoNet(nn.Module):
                 m.weight.data.normal_(0, 0.005)
 
     def forward(self, x, y):
-        x1 = self.convnet(x)
-        x1 = x1.view(x.size(0), 256*6*6)
-        x2 = self.convnet(y)
-        x2 = x2.view(x.size(0), 256*6*6)
+        # run both frames through the convnet as a single batch
+        N = x.size(0)
+        with torch.no_grad():
+            f = self.convnet(torch.cat((x, y), 0))
+        x1 = f[:N].view(N, 256*6*6)
+        x2 = f[N:].view(N, 256*6*6)
         x = torch.cat((x1, x2), 1)
         x = self.classifier(x)
         return x
 
-class SPPGoNet(nn.Module):
+class SPPGoNet(_GoNetMixin, nn.Module):
     """ Neural Network class
         Two stream model:
         ________
@@ -83,13 +155,14 @@ class SPPGoNet(nn.Module):
     """
     def __init__(self):
         super(SPPGoNet, self).__init__()
-        caffenet = models.alexnet(pretrained=True)
-        self.convnet = nn.Sequential(*list(caffenet.children())[:-2])
+        self.convnet = _pretrained_convnet('conv_alexnet.pt',
+                                           _alexnet_layers, -2)
         self.avgPool1 = nn.AdaptiveAvgPool2d([7, 7])
         self.avgPool2 = nn.AdaptiveAvgPool2d([7, 7])
 
         for param in self.convnet.parameters():
             param.requires_grad = False
+        self.convnet.eval()
         self.classifier = nn.Sequential(
                 nn.Linear(256*7*7*4, 4096),
                 nn.ReLU(inplace=True),
@@ -119,29 +192,33 @@ class SPPGoNet(nn.Module):
         # x1 = x1.view(x1.size(0), 256*6*6)
         # x2 = self.convnet(x2)
         # x2 = x2.view(x2.size(0), 256*6*6)
-        x1_x2 = self.convnet(x1_x2)
+        # run both frames through the convnet as a single batch
+        N = x1_x2.size(0)
+        with torch.no_grad():
+            f = self.convnet(torch.cat((x1_x2, x2_x2), 0))
+        x1_x2, x2_x2 = f[:N], f[N:]
 
         x1 = x1_x2[:, :, 3:10, 3:10]
-        x1 = x1.contiguous().view(x1.size(0), 256*7*7)
+        x1 = x1.reshape(x1.size(0), 256*7*7)
 
 
         x1_x2 = self.avgPool1(x1_x2)
         x1_x2 = x1_x2.view(x1_x2.size(0), 256*7*7)
 
-        x2_x2 = self.convnet(x2_x2)
-
         x2 = x2_x2[:,:, 3:10, 3:10]
-        x2 = x2.contiguous().view(x2.size(0), 256*7*7)
+        x2 = x2.reshape(x2.size(0), 256*7*7)
 
         x2_x2 = self.avgPool2(x2_x2)
         x2_x2 = x2_x2.view(x2_x2.size(0), 256*7*7)
 
 
+        # the concat is cheap, applying slices of the first Linear weight to
+        # each feature instead makes backward allocate full-size gradients
         x = torch.cat((x1, x2, x1_x2, x2_x2), 1)
         x = self.classifier(x)
         return x
 
-class SPPSqueezeGoNet(nn.Module):
+class SPPSqueezeGoNet(_GoNetMixin, nn.Module):
     """ Neural Network class
         Two stream model:
         ________
@@ -162,14 +239,14 @@ class SPPSqueezeGoNet(nn.Module):
     """
     def __init__(self):
         super(SPPSqueezeGoNet, self).__init__()
-        caffenet = models.squeezenet1_1(pretrained=True)
-        squeezenet_feature_layers = list(caffenet.children())[:-1]
-        self.convnet = nn.Sequential(*list(*squeezenet_feature_layers)[:-5])
+        self.convnet = _pretrained_convnet('conv_squeezenet1_1_8.pt',
+                                           _squeezenet_layers, -5)
         self.avgPool1 = nn.AdaptiveAvgPool2d([7, 7])
         self.avgPool2 = nn.AdaptiveAvgPool2d([7, 7])
 
         for param in self.convnet.parameters():
             param.requires_grad = False
+        self.convnet.eval()
         self.classifier = nn.Sequential(
                 nn.Linear(256*7*7*4, 4096),
                 nn.ReLU(inplace=True),
@@ -195,23 +272,23 @@ class SPPSqueezeGoNet(nn.Module):
                 m.weight.data.normal_(0, 0.005)
 
     def forward(self, x1, x2, x1_x2, x2_x2):
-        x1_x2 = F.upsample(x1_x2, size=(128, 128), mode='bilinear')
-        x2_x2 = F.upsample(x2_x2, size=(128, 128), mode='bilinear')
-
-
-        x1_x2 = self.convnet(x1_x2)
+        # upsample and run both frames through the convnet as a single batch
+        N = x1_x2.size(0)
+        xy = F.interpolate(torch.cat((x1_x2, x2_x2), 0), size=(128, 128),
+                           mode='bilinear', align_corners=False)
+        with torch.no_grad():
+            f = self.convnet(xy)
+        x1_x2, x2_x2 = f[:N], f[N:]
 
         x1 = x1_x2[:, :, 4:11, 4:11]
-        x1 = x1.contiguous().view(x1.size(0), 256*7*7)
+        x1 = x1.reshape(x1.size(0), 256*7*7)
 
 
         x1_x2 = self.avgPool1(x1_x2)
         x1_x2 = x1_x2.view(x1_x2.size(0), 256*7*7)
 
-        x2_x2 = self.convnet(x2_x2)
-
         x2 = x2_x2[:, :, 4:11, 4:11]
-        x2 = x2.contiguous().view(x2.size(0), 256*7*7)
+        x2 = x2.reshape(x2.size(0), 256*7*7)
 
         x2_x2 = self.avgPool2(x2_x2)
         x2_x2 = x2_x2.view(x2_x2.size(0), 256*7*7)
@@ -221,7 +298,7 @@ class SPPSqueezeGoNet(nn.Module):
         x = self.classifier(x)
         return x
 
-class SPPSqueezeGoNet2(nn.Module):
+class SPPSqueezeGoNet2(_GoNetMixin, nn.Module):
     """ Neural Network class
         Two stream model:
         ________
@@ -242,14 +319,14 @@ class SPPSqueezeGoNet2(nn.Module):
     """
     def __init__(self):
         super(SPPSqueezeGoNet2, self).__init__()
-        caffenet = models.squeezenet1_1(pretrained=True)
-        squeezenet_feature_layers = list(caffenet.children())[:-1]
-        self.convnet = nn.Sequential(*list(*squeezenet_feature_layers)[:-4])
+        self.convnet = _pretrained_convnet('conv_squeezenet1_1_9.pt',
+                                           _squeezenet_layers, -4)
         self.avgPool1 = nn.AdaptiveAvgPool2d([5, 5])
         self.avgPool2 = nn.AdaptiveAvgPool2d([5, 5])
 
         for param in self.convnet.parameters():
             param.requires_grad = False
+        self.convnet.eval()
         self.classifier = nn.Sequential(
                 nn.Linear(256*5*5*4, 4096),
                 nn.ReLU(inplace=True),
@@ -275,23 +352,23 @@ class SPPSqueezeGoNet2(nn.Module):
                 m.weight.data.normal_(0, 0.005)
 
     def forward(self, x1, x2, x1_x2, x2_x2):
-        x1_x2 = F.upsample(x1_x2, size=(256, 256), mode='bilinear')
-        x2_x2 = F.upsample(x2_x2, size=(256, 256), mode='bilinear')
-
-
-        x1_x2 = self.convnet(x1_x2)
+        # upsample and run both frames through the convnet as a single batch
+        N = x1_x2.size(0)
+        xy = F.interpolate(torch.cat((x1_x2, x2_x2), 0), size=(256, 256),
+                           mode='bilinear', align_corners=False)
+        with torch.no_grad():
+            f = self.convnet(xy)
+        x1_x2, x2_x2 = f[:N], f[N:]
 
         x1 = x1_x2[:, :, 5:10, 5:10]
-        x1 = x1.contiguous().view(x1.size(0), 256*5*5)
+        x1 = x1.reshape(x1.size(0), 256*5*5)
 
 
         x1_x2 = self.avgPool1(x1_x2)
         x1_x2 = x1_x2.view(x1_x2.size(0), 256*5*5)
 
-        x2_x2 = self.convnet(x2_x2)
-
         x2 = x2_x2[:, :, 5:10, 5:10]
-        x2 = x2.contiguous().view(x2.size(0), 256*5*5)
+        x2 = x2.reshape(x2.size(0), 256*5*5)
 
         x2_x2 = self.avgPool2(x2_x2)
         x2_x2 = x2_x2.view(x2_x2.size(0), 256*5*5)
@@ -35,6 +35,8 @@ class GOTURN:
         checkpoint = torch.load(
             model_path, map_location=lambda storage, loc: storage)
         self.model.load_state_dict(checkpoint['state_dict'])
+        self.model.to_inference()
+        self.model.eval()
         self.model.to(device)
         frames = os.listdir(root_dir + '/img')
         frames = [root_dir + "/img/" + frame for frame in frames]
@@ -101,7 +103,8 @@ class GOTURN:
         x1, x2 = sample['previmg'], sample['currimg']
         x1 = x1.unsqueeze(0).to(self.device)
         x2 = x2.unsqueeze(0).to(self.device)
-        y = self.model(x1, x2)
+        with torch.no_grad():
+            y = self.model(x1, x2)
         bb = y.data.cpu().numpy().transpose((1, 0))
         bb = bb[:, 0]
         bbox = BoundingBox(bb[0], bb[1], bb[2], bb[3])
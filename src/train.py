@@ -1,11 +1,11 @@
 # necessary imports
 import os
-import sys
 import time
 import argparse
 
 import torch
 import torch.optim as optim
+from torch.utils.data import Dataset, DataLoader
 import numpy as np
 import model
 # from torchsummary import summary
@@ -13,7 +13,8 @@ import tensorboardX
 
 from datasets import ALOVDataset, ILSVRC2014_DET_Dataset
 from helper import (Rescale, shift_crop_training_sample,
-                    crop_sample, NormalizeToTensor)
+                    crop_sample, NormalizeToTensor, ToByteTensor,
+                    IMAGENET_MEAN, IMAGENET_STD, enable_fast_backends)
 
 # constants
 cuda = torch.cuda.is_available()
@@ -22,12 +23,10 @@ input_size = 224
 kSaveModel = 20000  # save model after every 20000 steps
 batchSize = 50  # number of samples in a batch
 kGeneratedExamplesPerImage = 10  # generate 10 synthetic samples per image
-transform = NormalizeToTensor()
+transform = ToByteTensor()  # images are normalized on the device
 bb_params = {}
 enable_tensorboard = True
-if enable_tensorboard:
-    from tensorboardX import SummaryWriter
-    writer = SummaryWriter()
+writer = None  # created in main(), not in data loading worker processes
 
 args = None
 parser = argparse.ArgumentParser(description='GOTURN Training')
@@ -65,20 +64,33 @@ parser.add_argument('-b', '--batch-size', default=50, type=int,
                     help='number of samples in batch (default: 50)')
 parser.add_argument('--save-freq', default=20000, type=int,
                     help='save checkpoint frequency (default: 20000)')
+parser.add_argument('--print-freq', default=50, type=int,
+                    help='print average loss every n steps (default: 50)')
+parser.add_argument('-workers', '--num-workers', default=None, type=int,
+                    help='number of data loading workers '
+                         '(default: number of CPUs, at most 16)')
 
 
 def main():
 
-    global args, batchSize, kSaveModel, bb_params
+    global args, batchSize, kSaveModel, bb_params, writer
     args = parser.parse_args()
     print(args)
+    if enable_tensorboard:
+        from tensorboardX import SummaryWriter
+        writer = SummaryWriter()
     batchSize = args.batch_size
     kSaveModel = args.save_freq
+    if args.num_workers is None:
+        args.num_workers = min(os.cpu_count() or 4, 16)
+    print('Using %d data loading workers' % (args.num_workers))
     np.random.seed(args.manual_seed)
     torch.manual_seed(args.manual_seed)
     if cuda:
         torch.cuda.manual_seed_all(args.manual_seed)
 
+    enable_fast_backends()
+
     # load bounding box motion model params
     bb_params['lambda_shift_frac'] = args.lambda_shift_frac
     bb_params['lambda_scale_frac'] = args.lambda_scale_frac
@@ -102,10 +114,23 @@ def main():
     #list of datasets to train on
     datasets = [alov, ]
 
+    # training samples are generated by DataLoader worker processes
+    loader_kwargs = {'batch_size': None,
+                     'shuffle': True,
+                     'num_workers': args.num_workers,
+                     'pin_memory': False,  # BatchBuilder owns pinned buffers
+                     'worker_init_fn': worker_init_fn}
+    if args.num_workers > 0:
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = 4
+    loaders = [DataLoader(TrainingSampleDataset(dataset, bb_params),
+                          **loader_kwargs)
+               for dataset in datasets]
+
     # load model
     net = model.SPPGoNet().to(device)
     # summary(net, [(3, 224, 224), (3, 224, 224)])
-    loss_fn = torch.nn.L1Loss(size_average=False).to(device)
+    loss_fn = torch.nn.L1Loss(reduction='sum').to(device)
 
     # initialize optimizer
     optimizer = optim.SGD(net.classifier.parameters(),
@@ -119,7 +144,7 @@ def main():
         os.makedirs(args.save_directory)
 
     # start training
-    net = train_model(net, datasets, loss_fn, optimizer)
+    net = train_model(net, loaders, loss_fn, optimizer)
 
     # save trained model
     checkpoint = {'state_dict': net.state_dict()}
@@ -127,98 +152,176 @@ def main():
     torch.save(checkpoint, path)
 
 
-def get_training_batch(num_running_batch, running_batch, dataset):
+class TrainingSampleDataset(Dataset):
+    '''
+    Wraps a tracking dataset so that GOTURN training samples can be
+    generated in parallel by DataLoader worker processes. Each item is a
+    batch of (kGeneratedExamplesPerImage+1) samples built from one image.
+
+    Everything the workers need is held by the instance, so it also works
+    with the 'spawn' start method where workers do not inherit the
+    globals set up in main().
+    '''
+    def __init__(self, dataset, bb_params):
+        super(TrainingSampleDataset, self).__init__()
+        self.dataset = dataset
+        self.bb_params = dict(bb_params)
+
+    def __len__(self):
+        return self.dataset.len
+
+    def __getitem__(self, idx):
+        return make_transformed_samples(self.dataset, idx, self.bb_params)
+
+
+def worker_init_fn(worker_id):
+    '''
+    Seeds numpy differently in every worker, otherwise forked workers
+    generate identical random crops.
+    '''
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
+def cycle(loader):
+    '''
+    Iterates over a DataLoader indefinitely.
+    '''
+    while True:
+        for samples in loader:
+            yield samples
+
+
+class BatchBuilder(object):
     '''
     Implements GOTURN batch formation regimen.
+
+    Samples are copied in place into batch buffers which are allocated once
+    (in pinned memory when training on GPU). Two sets of buffers are used
+    alternately so that the samples spilling over into the next batch do
+    not overwrite the batch which is being trained on.
     '''
-    global args, batchSize
-    done = False
-    N = kGeneratedExamplesPerImage+1
-    train_batch = None
-    x1_batch, x2_batch, x1_batch_x2, x2_batch_x2, y_batch = make_transformed_samples(dataset, args)
-    assert(x1_batch.shape[0] == x2_batch.shape[0] == x1_batch_x2.shape[0] == x2_batch_x2.shape[0] == y_batch.shape[0] == N)
-    count_in = min(batchSize - num_running_batch, N)
-    remain = N - count_in
-    running_batch['previmg'][num_running_batch:
-                             num_running_batch+count_in] = x1_batch[:count_in]
-    running_batch['currimg'][num_running_batch:
-                             num_running_batch+count_in] = x2_batch[:count_in]
-    running_batch['previmg_x2'][num_running_batch:
-                             num_running_batch+count_in] = x1_batch_x2[:count_in]
-    running_batch['currimg_x2'][num_running_batch:
-                             num_running_batch+count_in] = x2_batch_x2[:count_in]
-    running_batch['currbb'][num_running_batch:
-                            num_running_batch+count_in] = y_batch[:count_in]
-    num_running_batch = num_running_batch + count_in
-    if remain > 0:
-        done = True
-        train_batch = running_batch.copy()
-        running_batch['previmg'][:remain] = x1_batch[-remain:]
-        running_batch['currimg'][:remain] = x2_batch[-remain:]
-        running_batch['previmg_x2'][:remain] = x1_batch_x2[-remain:]
-        running_batch['currimg_x2'][:remain] = x2_batch_x2[-remain:]
-        running_batch['currbb'][:remain] = y_batch[-remain:]
-        num_running_batch = remain
-    return running_batch, train_batch, done, num_running_batch
-
-
-def make_transformed_samples(dataset, args):
+    keys = ['previmg', 'currimg', 'previmg_x2', 'currimg_x2', 'currbb']
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.buffers = [self._allocate(), self._allocate()]
+        self.current = 0
+        self.num_samples = 0
+
+    def _allocate(self):
+        sz = input_size
+        batch = {'previmg': torch.empty(self.batch_size, 3, sz, sz,
+                                        dtype=torch.uint8),
+                 'currimg': torch.empty(self.batch_size, 3, sz, sz,
+                                        dtype=torch.uint8),
+                 'previmg_x2': torch.empty(self.batch_size, 3, sz*2, sz*2,
+                                           dtype=torch.uint8),
+                 'currimg_x2': torch.empty(self.batch_size, 3, sz*2, sz*2,
+                                           dtype=torch.uint8),
+                 'currbb': torch.empty(self.batch_size, 4)}
+        if cuda:
+            batch = {key: x.pin_memory() for key, x in batch.items()}
+        return batch
+
+    @property
+    def running_batch(self):
+        return self.buffers[self.current]
+
+    def add(self, samples):
+        '''
+        Adds a batch of (kGeneratedExamplesPerImage+1) samples. Returns the
+        training batch once it is complete, None otherwise.
+        '''
+        N = kGeneratedExamplesPerImage+1
+        assert(all(x.shape[0] == N for x in samples))
+        count_in = min(self.batch_size - self.num_samples, N)
+        start = self.num_samples
+        for key, x in zip(self.keys, samples):
+            self.running_batch[key][start:start+count_in].copy_(x[:count_in])
+        self.num_samples = start + count_in
+        if self.num_samples < self.batch_size:
+            return None
+        train_batch = self.running_batch
+        self.current = 1 - self.current
+        remain = N - count_in
+        for key, x in zip(self.keys, samples):
+            self.running_batch[key][:remain].copy_(x[count_in:])
+        self.num_samples = remain
+        return train_batch
+
+    def load(self, num_samples, running_batch):
+        '''
+        Restores a running batch saved in a checkpoint. Checkpoints written
+        before images were kept as uint8 hold ImageNet normalized float
+        images, those are de-normalized back to [0, 255].
+        '''
+        mean = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1) * 255
+        std = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1) * 255
+        for key, x in running_batch.items():
+            if key != 'currbb' and x.dtype != torch.uint8:
+                x = (x * std + mean).round_().clamp_(0, 255)
+            self.running_batch[key].copy_(x)
+        self.num_samples = num_samples
+
+    def to_device(self, batch):
+        '''
+        Copies a training batch to the device. Copies from the pinned
+        buffers are asynchronous, the buffers are only written again after
+        the training step on this batch synchronized in loss.item().
+        '''
+        return {key: x.to(device, non_blocking=True)
+                for key, x in batch.items()}
+
+
+def make_transformed_samples(dataset, idx, bb_params):
     '''
-    Given a dataset, it picks a random sample from it and returns a batch
-    of (kGeneratedExamplesPerImage+1) samples. The batch contains true sample
-    from dataset and kGeneratedExamplesPerImage samples, which are created
-    artifically with augmentation by GOTURN smooth motion model.
+    Given a dataset, a sample index and the bounding box motion model
+    params, it returns a batch of (kGeneratedExamplesPerImage+1) samples.
+    The batch contains true sample from dataset and
+    kGeneratedExamplesPerImage samples, which are created artifically with
+    augmentation by GOTURN smooth motion model.
     '''
-    idx = np.random.randint(dataset.len, size=1)[0]
+    N = kGeneratedExamplesPerImage + 1
+    sz = input_size
+    # samples are collected as image arrays and converted to tensors at once
+    batch = {'previmg': np.empty((N, sz, sz, 3), dtype=np.uint8),
+             'currimg': np.empty((N, sz, sz, 3), dtype=np.uint8),
+             'previmg_x2': np.empty((N, sz*2, sz*2, 3), dtype=np.uint8),
+             'currimg_x2': np.empty((N, sz*2, sz*2, 3), dtype=np.uint8),
+             'currbb': np.empty((N, 4), dtype=np.float32)}
+
     # unscaled original sample (single image and bb)
     orig_sample = dataset.get_orig_sample(idx)
-    # cropped scaled sample (two frames and bb)
+    # initialize batch with the true sample (two frames and bb)
     true_sample, _ = dataset.get_sample(idx)
-    true_tensor = transform(true_sample)
-    x1_batch = torch.Tensor(kGeneratedExamplesPerImage + 1, 3,
-                            input_size, input_size)
-    x2_batch = torch.Tensor(kGeneratedExamplesPerImage + 1, 3,
-                            input_size, input_size)
-    x1_batch_x2 = torch.Tensor(kGeneratedExamplesPerImage + 1, 3,
-                            input_size*2, input_size*2)
-    x2_batch_x2 = torch.Tensor(kGeneratedExamplesPerImage + 1, 3,
-                            input_size*2, input_size*2)
-    y_batch = torch.Tensor(kGeneratedExamplesPerImage + 1, 4)
-
-    # initialize batch with the true sample
-    x1_batch[0] = true_tensor['previmg']
-    x2_batch[0] = true_tensor['currimg']
-    x1_batch_x2[0] = true_tensor['previmg_x2']
-    x2_batch_x2[0] = true_tensor['currimg_x2']
-    y_batch[0] = true_tensor['currbb']
+    for key in batch:
+        batch[key][0] = true_sample[key]
 
     scale = Rescale((input_size, input_size))
+    # unscaled previous image crop with box, it does not depend on the
+    # random shift and is the same for all generated samples
+    prev_sample, opts_prev = crop_sample(orig_sample)
+    prev_sample_x2, opts_prev_x2 = crop_sample(orig_sample, contextFactor=4)
+    prev_sample['image_x2'] = prev_sample_x2['image']
+    scaled_prev_obj = scale(prev_sample, opts_prev)
+    batch['previmg'][1:] = scaled_prev_obj['image']
+    batch['previmg_x2'][1:] = scaled_prev_obj['image_x2']
+
     for i in range(kGeneratedExamplesPerImage):
         sample = orig_sample
         # unscaled current image crop with box
         curr_sample, opts_curr = shift_crop_training_sample(sample, bb_params)
-        # unscaled previous image crop with box
-        prev_sample, opts_prev = crop_sample(sample)
-        prev_sample_x2, opts_prev_x2 = crop_sample(sample, contextFactor=4)
-        prev_sample['image_x2'] = prev_sample_x2['image']
         scaled_curr_obj = scale(curr_sample, opts_curr)
-        scaled_prev_obj = scale(prev_sample, opts_prev)
-        training_sample = {'previmg': scaled_prev_obj['image'],
-                           'currimg': scaled_curr_obj['image'],
-                           'previmg_x2': scaled_prev_obj['image_x2'],
-                           'currimg_x2': scaled_curr_obj['image_x2'],
-                           'currbb': scaled_curr_obj['bb']}
-        sample = transform(training_sample)
-        x1_batch[i+1] = sample['previmg']
-        x2_batch[i+1] = sample['currimg']
-        x1_batch_x2[i+1] = sample['previmg_x2']
-        x2_batch_x2[i+1] = sample['currimg_x2']
-        y_batch[i+1] = sample['currbb']
+        batch['currimg'][i+1] = scaled_curr_obj['image']
+        batch['currimg_x2'][i+1] = scaled_curr_obj['image_x2']
+        batch['currbb'][i+1] = scaled_curr_obj['bb']
 
-    return x1_batch, x2_batch, x1_batch_x2, x2_batch_x2, y_batch
+    batch = transform(batch)
+    return (batch['previmg'], batch['currimg'], batch['previmg_x2'],
+            batch['currimg_x2'], batch['currbb'])
 
 
-def train_model(model, datasets, criterion, optimizer):
+def train_model(model, loaders, criterion, optimizer):
 
     global args, writer
     since = time.time()
@@ -226,15 +329,15 @@ def train_model(model, datasets, criterion, optimizer):
     lr = args.learning_rate
     flag = False
     start_itr = 0
-    num_running_batch = 0
-    running_batch = {'previmg': torch.Tensor(batchSize, 3, input_size, input_size),
-                     'currimg': torch.Tensor(batchSize, 3, input_size, input_size),
-                     'previmg_x2': torch.Tensor(batchSize, 3, input_size*2, input_size*2),
-                     'currimg_x2': torch.Tensor(batchSize, 3, input_size*2, input_size*2),
-                     'currbb': torch.Tensor(batchSize, 4)}
+    batch_builder = BatchBuilder(batchSize)
+    # mean and std scaled by 255 since images arrive as uint8 in [0, 255]
+    mean = torch.tensor(IMAGENET_MEAN, device=device).view(1, 3, 1, 1) * 255
+    std = torch.tensor(IMAGENET_STD, device=device).view(1, 3, 1, 1) * 255
     scheduler = optim.lr_scheduler.StepLR(optimizer,
                                           step_size=args.lr_decay_step,
                                           gamma=args.gamma)
+    # mixed precision training, the fully connected layers run on tensor cores
+    scaler = torch.cuda.amp.GradScaler(enabled=cuda)
 
     # resume from a checkpoint
     if args.resume:
@@ -245,8 +348,10 @@ def train_model(model, datasets, criterion, optimizer):
             model.load_state_dict(checkpoint['state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer'])
             scheduler.load_state_dict(checkpoint['scheduler'])
-            num_running_batch = checkpoint['num_running_batch']
-            running_batch = checkpoint['running_batch']
+            if 'scaler' in checkpoint:
+                scaler.load_state_dict(checkpoint['scaler'])
+            batch_builder.load(checkpoint['num_running_batch'],
+                               checkpoint['running_batch'])
             lr = checkpoint['lr']
             np.random.set_state(checkpoint['np_rand_state'])
             torch.set_rng_state(checkpoint['torch_rand_state'])
@@ -258,8 +363,10 @@ def train_model(model, datasets, criterion, optimizer):
     if not os.path.isdir(args.save_directory):
         os.makedirs(args.save_directory)
 
+    samplers = [cycle(loader) for loader in loaders]
     itr = start_itr
     st = time.time()
+    losses = []
     while itr < args.num_batches:
 
         model.train()
@@ -273,43 +380,46 @@ def train_model(model, datasets, criterion, optimizer):
 
         # train on datasets
         # usually ALOV and ImageNet
-        while i < len(datasets):
-            dataset = datasets[i]
+        while i < len(samplers):
+            samples = next(samplers[i])
             i = i+1
-            (running_batch, train_batch,
-                done, num_running_batch) = get_training_batch(num_running_batch,
-                                                              running_batch,
-                                                              dataset)
-            # print(i, num_running_batch, done)
-            if done:
+            train_batch = batch_builder.add(samples)
+            if train_batch is not None:
                 scheduler.step()
                 # load sample
-                x1 = train_batch['previmg'].to(device)
-                x2 = train_batch['currimg'].to(device)
-                x1_x2 = train_batch['previmg_x2'].to(device)
-                x2_x2 = train_batch['currimg_x2'].to(device)
-                y = train_batch['currbb'].requires_grad_(False).to(device)
+                batch = batch_builder.to_device(train_batch)
+                x1 = normalize(batch['previmg'], mean, std)
+                x2 = normalize(batch['currimg'], mean, std)
+                x1_x2 = normalize(batch['previmg_x2'], mean, std)
+                x2_x2 = normalize(batch['currimg_x2'], mean, std)
+                y = batch['currbb']
 
                 # zero the parameter gradients
                 optimizer.zero_grad()
 
                 # forward
-                output = model(x1, x2, x1_x2, x2_x2)
-                loss = criterion(output, y)
+                with torch.cuda.amp.autocast(enabled=cuda):
+                    output = model(x1, x2, x1_x2, x2_x2)
+                # summed loss is computed in FP32
+                loss = criterion(output.float(), y)
 
                 # backward + optimize
-                loss.backward()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 # statistics
                 curr_loss = loss.item()
-                end = time.time()
+                losses.append(curr_loss)
                 itr = itr + 1
-                print('[training] step = %d/%d, loss = %f, time = %f'
-                      % (itr, args.num_batches, curr_loss, end-st))
-                sys.stdout.flush()
-                del(train_batch)
-                st = time.time()
+                if itr % args.print_freq == 0:
+                    end = time.time()
+                    print('[training] step = %d/%d, avg loss over last %d '
+                          'steps = %f, time = %f'
+                          % (itr, args.num_batches, len(losses),
+                             np.mean(losses), end-st))
+                    losses = []
+                    st = time.time()
 
                 if enable_tensorboard:
                     writer.add_scalar('train/batch_loss', curr_loss, itr)
@@ -325,8 +435,11 @@ def train_model(model, datasets, criterion, optimizer):
                                      'state_dict': model.state_dict(),
                                      'optimizer': optimizer.state_dict(),
                                      'scheduler': scheduler.state_dict(),
-                                     'num_running_batch': num_running_batch,
-                                     'running_batch': running_batch,
+                                     'scaler': scaler.state_dict(),
+                                     'num_running_batch':
+                                         batch_builder.num_samples,
+                                     'running_batch':
+                                         batch_builder.running_batch,
                                      'lr': lr,
                                      'dataset_indx': i}, path)
 
@@ -339,6 +452,13 @@ def train_model(model, datasets, criterion, optimizer):
     return model
 
 
+def normalize(images, mean, std):
+    '''
+    Converts a uint8 image batch to float and normalizes it on its device.
+    '''
+    return images.float().sub_(mean).div_(std)
+
+
 def save_checkpoint(state, filename='checkpoint.pth.tar'):
     torch.save(state, filename)
 